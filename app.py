@@ -3,6 +3,7 @@
 
 import argparse
 import format
+import metrics
 import os
 import pandas as pd
 import pytz
@@ -10,8 +11,8 @@ import random
 import string
 import yaml
 
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
-from typing import Union
 
 ###########
 # GLOBALS #
@@ -29,9 +30,40 @@ OUTPUT_DIR = os.path.join(os.path.dirname(__file__), 'debug')
 # Name of the file to write the Restaurant table debug artifacts to
 RESTAURANT_MATCH_PATH = os.path.join(OUTPUT_DIR, 'Restaurant_match.csv')
 
+# Name of the file to write the rows of conflicting restaurants to
+RESTAURANT_CONFLICT_ROWS_PATH = os.path.join(
+    OUTPUT_DIR, 'Restaurant_conflict_rows.csv')
+
 # Statistics about the data conversion
 G_stats = {}
 
+# Progress of each stage, written to disk when --metrics is given
+G_metrics = metrics.Reporter()
+
+# Restaurant table columns and the OpenRestaurantInspections columns they are
+# filled from
+RESTAURANT_COLUMNS = {
+    'Name': 'Name',
+    'LegalBusinessName': 'LegalBusinessName',
+    'StreetAddress': 'StreetAddress',
+    'Borough': 'Borough',
+    'Zipcode': 'Postcode',
+    'Latitude': 'Latitude',
+    'Longitude': 'Longitude',
+    'CommunityBoard': 'CommunityBoard',
+    'CouncilDistrict': 'CouncilDistrict',
+    'CensusTract': 'CensusTract',
+    'BIN': 'BIN',
+    'BBL': 'BBL',
+    'NTA': 'NTA'
+}
+
+# Columns compared with a tolerance when detecting restaurant conflicts
+COORDINATE_COLUMNS = ['Latitude', 'Longitude']
+
+# Maximum difference in degrees for two coordinates to be considered equal
+COORDINATE_TOLERANCE = 1e-6
+
 
 primaryKeyLength = 16
 
@@ -41,142 +73,191 @@ primaryKeyLength = 16
 #############
 
 
-def matchRestaraunt(row: pd.Series, restaurants: list[dict]) -> Union[dict, None]:
+def resolveShard(addresses: pd.Series) -> tuple[list[int], list]:
     '''
-    Check if a restaurant already exists in the list of restaurants. Match by street address.
+    Resolve the restaurants within a single Postcode. Match by street address.
+
+    Returns the restaurant number of each row, in the order of addresses, and
+    the index of the row each restaurant was created from.
     '''
 
-    for restaurant in restaurants:
-        if restaurant['StreetAddress'] == row['StreetAddress']:
-            return restaurant
+    codes = []
+    first_rows = []
+    by_address = {}
+
+    for index, address in addresses.items():
+
+        # A missing address never matches another restaurant
+        if not pd.isna(address) and address in by_address:
+            codes.append(by_address[address])
+            continue
+
+        if not pd.isna(address):
+            by_address[address] = len(first_rows)
+
+        codes.append(len(first_rows))
+        first_rows.append(index)
 
-    return None
+    return codes, first_rows
 
 
-def mergeRestaurants(match: dict, row: pd.Series) -> None:
+def findRestaurantConflicts(df: pd.DataFrame) -> pd.DataFrame:
     '''
-    Merge strategy is that values should be exactly the same. If they are not
-    then raise an exception.
+    Merge strategy is that values should be exactly the same for every row
+    assigned to the same restaurant. Each row is compared against the row the
+    restaurant was created from in a single grouped pass.
+
+    Missing values are considered equal to each other and coordinates are
+    compared with a tolerance of COORDINATE_TOLERANCE.
+
+    Returns a boolean conflict matrix indexed by RestaurantID with one column
+    per Restaurant table column. Only restaurants with at least one conflict
+    are included.
     '''
 
-    unmatched_keys = []
+    columns = list(RESTAURANT_COLUMNS.values())
 
-    for key, value in match.items():
+    # The restaurant was created from the first row with its RestaurantID
+    first = df.loc[~df['RestaurantID'].duplicated(), ['RestaurantID'] + columns]
+    reference = first.set_index('RestaurantID').reindex(df['RestaurantID'])
+    reference.index = df.index
 
-        # No need to check ID wiht Restaurant ID since it is the same
-        if key == 'ID':
-            continue
-        elif key == 'Zipcode':
-            if value != row['Postcode']:
-                unmatched_keys.append(key)
-                continue
+    conflicts = pd.DataFrame(index=df.index)
+
+    for key, column in RESTAURANT_COLUMNS.items():
+        value = df[column]
+        expected = reference[column]
+
+        both_missing = value.isna() & expected.isna()
+
+        if column in COORDINATE_COLUMNS:
+            equal = (value - expected).abs() <= COORDINATE_TOLERANCE
         else:
-            if value != row[key]:
-                unmatched_keys.append(key)
-    
-    if len(unmatched_keys) > 0:
-        raise Exception(f'Unmatched keys: {unmatched_keys}')
+            equal = value == expected
+
+        conflicts[key] = ~(equal | both_missing)
 
+    matrix = conflicts.groupby(df['RestaurantID'], sort=False).any()
 
-def fillRestaurantTable(tables: dict[str, pd.DataFrame], datasets: dict[str, pd.DataFrame], debug=False) -> None:
+    return matrix[matrix.any(axis=1)]
+
+
+def fillRestaurantTable(tables: dict[str, pd.DataFrame], datasets: dict[str, pd.DataFrame], debug=False, workers=1) -> None:
     '''
-    Fill the Restaurant table
+    Fill the Restaurant table. Matching never crosses a Postcode so each
+    Postcode is resolved independently, in a pool of worker processes when
+    workers is greater than one.
     '''
 
     if 'OpenRestaurantInspections' in datasets:
 
-        if debug:
-            # Remove Restaurant_match.csv if it exists using try and except
-            try:
-                os.remove(RESTAURANT_MATCH_PATH)
-            except:
-                pass
-
         df = datasets['OpenRestaurantInspections']
 
-        # Allocate a column for RestaurantID
-        df['RestaurantID'] = ''
-
         # Organize restaurants by zip code for quicker matching
-        by_zip = {}
-
-        # Iterate through rows and add to table if restarant does not exist
-        for index, row in tqdm(df.iterrows()):
-
-            if row['Postcode'] not in by_zip:
-                by_zip[row['Postcode']] = []
-
-            match = matchRestaraunt(row, by_zip[row['Postcode']])
-            if match is not None:
-
-                df.loc[index, 'RestaurantID'] = match['ID']
-
-                try:
-                    mergeRestaurants(match, row)
-                except Exception as e:
-
-                    print(e)
-
-                    if debug:
-                        with open('debug/Restaurant_match.csv', 'a') as file:
-
-                            formatted_restaurant = {
-                                'ID': match['ID'],
-                                'Name': row['Name'],
-                                'LegalBusinessName': row['LegalBusinessName'],
-                                'StreetAddress': row['StreetAddress'],
-                                'Borough': row['Borough'],
-                                'Zipcode': row['Postcode'],
-                                'Latitude': row['Latitude'],
-                                'Longitude': row['Longitude'],
-                                'CommunityBoard': row['CommunityBoard'],
-                                'CouncilDistrict': row['CouncilDistrict'],
-                                'CensusTract': row['CensusTract'],
-                                'BIN': row['BIN'],
-                                'BBL': row['BBL'],
-                                'NTA': row['NTA']
-                            }
-                                                
-                            file.write(e.args[0] + '\n')
-                            pd.DataFrame([match, formatted_restaurant]).to_csv(
-                                file, mode='a', index=False)
-                            file.write('\n')
-                    else:
-                        print('Restaurant does not match')
-                        exit()
-
-                continue
-            else:
+        shards = [addresses for _, addresses in df.groupby(
+            'Postcode', sort=False)['StreetAddress']]
+
+        # A row without a Postcode never matches another restaurant
+        shards += [df['StreetAddress'].loc[[index]]
+                   for index in df.index[df['Postcode'].isna()]]
+
+        # Keep shards in the order their first row appears in the data
+        positions = df.index.get_indexer([shard.index[0] for shard in shards])
+        shards = [shard for _, shard in sorted(
+            zip(positions, shards), key=lambda x: x[0])]
+
+        results = [None] * len(shards)
+
+        progress = G_metrics.stage('Restaurant', len(df))
+
+        if workers > 1:
+            # Send shards in chunks to limit inter-process overhead on the
+            # many single-row shards
+            chunksize = max(1, len(shards) // (workers * 4))
+
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pending = len(shards)
+                progress.setQueueDepth(pending)
+
+                resolved = executor.map(resolveShard, shards, chunksize=chunksize)
+                for i, result in enumerate(tqdm(resolved, total=len(shards), desc='Restaurant', unit='zip')):
+                    results[i] = result
+
+                    progress.advance(len(shards[i]))
+                    pending -= 1
+                    progress.setQueueDepth(pending)
+        else:
+            for i, shard in enumerate(tqdm(shards, desc='Restaurant', unit='zip')):
+                results[i] = resolveShard(shard)
+                progress.advance(len(shard))
+
+        progress.finish()
+
+        ##############
+        # Assign IDs #
+        ##############
+
+        # Restaurants in Restaurant table order: by shard, then by first row
+        first_rows = [(i, code, row) for i, (_, rows) in enumerate(results)
+                      for code, row in enumerate(rows)]
+
+        # Draw IDs in the order restaurants first appear in the data so that a
+        # fixed seed produces the same IDs regardless of the number of workers
+        positions = df.index.get_indexer([row for _, _, row in first_rows])
+
+        ids = {}
+        used = set()
+        for _, (i, code, _) in sorted(zip(positions, first_rows), key=lambda x: x[0]):
+            id = str(generateRandomBits(64))
+            while id in used:
                 id = str(generateRandomBits(64))
+            used.add(id)
+            ids[(i, code)] = id
+
+        labels = []
+        restaurant_ids = []
+        for i, (shard, (codes, _)) in enumerate(zip(shards, results)):
+            labels.extend(shard.index)
+            restaurant_ids.extend(ids[(i, code)] for code in codes)
+
+        df['RestaurantID'] = pd.Series(restaurant_ids, index=labels, dtype='object')
 
-                by_zip[row['Postcode']].append({
-                    'ID': id,
-                    'Name': row['Name'],
-                    'LegalBusinessName': row['LegalBusinessName'],
-                    'StreetAddress': row['StreetAddress'],
-                    'Borough': row['Borough'],
-                    'Zipcode': row['Postcode'],
-                    'Latitude': row['Latitude'],
-                    'Longitude': row['Longitude'],
-                    'CommunityBoard': row['CommunityBoard'],
-                    'CouncilDistrict': row['CouncilDistrict'],
-                    'CensusTract': row['CensusTract'],
-                    'BIN': row['BIN'],
-                    'BBL': row['BBL'],
-                    'NTA': row['NTA']
-                })
-
-                df.loc[index, 'RestaurantID'] = id
-
-        restaurants = [place for places in by_zip.values() for place in places]
+        ######################
+        # Conflict Detection #
+        ######################
+
+        conflicts = findRestaurantConflicts(df)
+
+        G_stats['restaurant_conflicts'] = f'{len(conflicts)} / {df["RestaurantID"].nunique()}'
+
+        if debug:
+            # Always written so a clean run replaces the previous artifacts
+            conflicts.to_csv(RESTAURANT_MATCH_PATH)
+
+            # Values of every row of a conflicting restaurant, grouped by
+            # restaurant, for writing entries in edits.yaml
+            rows = df.loc[df['RestaurantID'].isin(conflicts.index),
+                          ['RestaurantID'] + list(RESTAURANT_COLUMNS.values())]
+            rows.sort_values('RestaurantID', kind='stable').to_csv(
+                RESTAURANT_CONFLICT_ROWS_PATH)
+
+        if len(conflicts) > 0 and not debug:
+            print('\nRestaurants do not match:')
+            print(conflicts.sum().to_string())
+            exit()
+
+        restaurants = df.loc[[row for _, _, row in first_rows],
+                             ['RestaurantID'] + list(RESTAURANT_COLUMNS.values())]
+        restaurants = restaurants.rename(
+            columns={'RestaurantID': 'ID', **{column: key for key, column in RESTAURANT_COLUMNS.items()}})
 
         tables['Restaurant'] = pd.concat(
-            [tables['Restaurant'], pd.DataFrame(restaurants)], ignore_index=True)
+            [tables['Restaurant'], restaurants], ignore_index=True)
 
 
-def fillSidewalkInspectionTable(tables: dict[str, pd.DataFrame], df: pd.DataFrame) -> None:
+def fillSidewalkInspectionTable(tables: dict[str, pd.DataFrame], datasets: dict[str, pd.DataFrame]) -> None:
     '''
-    Fill the Restaurant table
+    Fill the SidewalkInspection table
     '''
 
     if 'OpenRestaurantInspections' in datasets:
@@ -184,7 +265,9 @@ def fillSidewalkInspectionTable(tables: dict[str, pd.DataFrame], df: pd.DataFram
 
         to_add = []
 
-        for _, row in tqdm(df.iterrows()):
+        progress = G_metrics.stage('SidewalkInspection', len(df))
+
+        for _, row in tqdm(df.iterrows(), total=len(df), desc='SidewalkInspection'):
 
             to_add.append({
                 'ID': str(generateRandomBits(64)),
@@ -195,13 +278,17 @@ def fillSidewalkInspectionTable(tables: dict[str, pd.DataFrame], df: pd.DataFram
                 'AgencyCode': row['AgencyCode'],
             })
 
+            progress.advance()
+
+        progress.finish()
+
         tables['SidewalkInspection'] = pd.concat(
             [tables['SidewalkInspection'], pd.DataFrame(to_add)], ignore_index=True)
 
 
-def fillTables(datasets: dict[str, pd.DataFrame], tables: dict[str, pd.DataFrame], debug=False) -> None:
+def fillTables(datasets: dict[str, pd.DataFrame], tables: dict[str, pd.DataFrame], debug=False, workers=1) -> None:
 
-    fillRestaurantTable(tables, datasets, debug)
+    fillRestaurantTable(tables, datasets, debug, workers)
     fillSidewalkInspectionTable(tables, datasets)
 
 
@@ -326,7 +413,7 @@ def formatOpenRestaurantInspections(df: pd.DataFrame, debug=False) -> pd.DataFra
     ####################
 
     df['StreetAddress'] = format.normalizeAddress(
-        df['BusinessAddress'], G_stats)
+        df['BusinessAddress'], G_stats, G_metrics.stage('StreetAddress', len(df)))
 
     ###############
     # InspectedOn #
@@ -388,7 +475,7 @@ def formatRestaurantInspections(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-def assembleTables(datasets: dict[str, pd.DataFrame], debug=False) -> dict[str, pd.DataFrame]:
+def assembleTables(datasets: dict[str, pd.DataFrame], debug=False, workers=1) -> dict[str, pd.DataFrame]:
     '''
     Assemble the tables from the dataframes
     '''
@@ -429,7 +516,7 @@ def assembleTables(datasets: dict[str, pd.DataFrame], debug=False) -> dict[str,
         'Phone': pd.Series(dtype='string'),
         'Cuisine': pd.Series(dtype='string')})
 
-    fillTables(datasets, tables, debug)
+    fillTables(datasets, tables, debug, workers)
 
     return tables
 
@@ -443,8 +530,19 @@ if __name__ == '__main__':
                            help='Generate debug artifacts in debug/')
     argparser.add_argument('--verbose', '-v', action='store_true',
                            default=False, help='Print verbose output')
+    argparser.add_argument('--metrics', '-m', metavar='path', type=str, default=None,
+                           help='Write progress metrics in Prometheus text format to path')
+    argparser.add_argument('--workers', '-w', type=int, default=1,
+                           help='Number of processes used to match restaurants (only helps on multi-core machines)')
+    argparser.add_argument('--seed', '-s', type=int, default=None,
+                           help='Seed for generated IDs to make output reproducible')
     args = argparser.parse_args()
 
+    G_metrics.path = args.metrics
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
     # Read the dataset argument and check if it is one of the available datasets
     # in the config file
     with open(CONFIG_PATH) as file:
@@ -511,7 +609,7 @@ if __name__ == '__main__':
     # Assemble Tables #
     ###################
 
-    tables = assembleTables(datasets, args.debug)
+    tables = assembleTables(datasets, args.debug, args.workers)
 
     #################
     # Write To Disk #
@@ -1,9 +1,10 @@
+import metrics
 import pandas as pd
 import string
 import scourgify
 
 from tqdm import tqdm
-from typing import Dict
+from typing import Dict, Union
 
 keep_punctuation = ['&', '(', ')', '/']
 
@@ -100,9 +101,14 @@ def standardizeString(df: pd.DataFrame, subset: Dict[str, str]) -> pd.DataFrame:
     return df
 
 
-def normalizeAddress(column: pd.Series, statistics: dict) -> pd.Series:
+def normalizeAddress(column: pd.Series, statistics: dict, progress: Union[metrics.Stage, None] = None) -> pd.Series:
     '''
     Normalize address according to usps standards
+
+    Args:
+        column: The addresses to be normalized
+        statistics: Dictionary to record the number of unnormalizable addresses in
+        progress: Optional stage to report the number of addresses processed to
     '''
 
     count = 0
@@ -128,6 +134,12 @@ def normalizeAddress(column: pd.Series, statistics: dict) -> pd.Series:
 
             addresses.append(address)
 
+        if progress is not None:
+            progress.advance()
+
+    if progress is not None:
+        progress.finish()
+
     statistics['unnormalizable_addresses'] = f'{count} / {len(column)}: {count / len(column) * 100}%'
 
     return pd.Series(addresses, name=column.name)
@@ -0,0 +1,183 @@
+import os
+import time
+
+from typing import Union
+
+# Prefix for every metric written to the metrics file
+METRIC_PREFIX = 'restaurant_ingest'
+
+# Number of rows a stage processes between writes to the metrics file
+DEFAULT_BATCH_SIZE = 1000
+
+
+def currentMemory() -> Union[int, None]:
+    '''
+    Current resident memory of the process in bytes. Returns None where
+    /proc is unavailable (macOS, Windows) so no metric is written.
+    '''
+
+    try:
+        with open('/proc/self/statm') as file:
+            resident_pages = int(file.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class Stage:
+    '''
+    Progress of a single ingest stage. Rows are counted on every call to
+    advance but the metrics file is only written once per batch.
+    '''
+
+    def __init__(self, reporter: 'Reporter', name: str, total: Union[int, None], batch_size: int):
+        self.reporter = reporter
+        self.name = name
+        self.total = total
+        self.batch_size = batch_size
+        self.processed = 0
+        self.queue_depth = 0
+        self.done = False
+        self.started = time.monotonic()
+        self.finished = None
+        self._next_write = batch_size
+
+    def advance(self, n=1) -> None:
+        '''
+        Record n processed rows
+        '''
+
+        self.processed += n
+
+        if self.processed >= self._next_write:
+            self._next_write = self.processed + self.batch_size
+            self.reporter.write()
+
+    def setQueueDepth(self, depth: int) -> None:
+        '''
+        Record the number of units of work waiting to be processed. It is
+        written along with the next batch of rows
+        '''
+
+        self.queue_depth = depth
+
+    def finish(self) -> None:
+        '''
+        Mark the stage as complete and write the final metrics
+        '''
+
+        self.done = True
+        self.queue_depth = 0
+        self.finished = time.monotonic()
+        self.reporter.write()
+
+    def elapsed(self) -> float:
+        '''
+        Seconds since the stage started, or its total duration once finished
+        '''
+
+        end = self.finished if self.finished is not None else time.monotonic()
+        return end - self.started
+
+    def rate(self) -> float:
+        '''
+        Average rows per second since the stage started, not a recent rate
+        '''
+
+        elapsed = self.elapsed()
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    def eta(self) -> Union[float, None]:
+        '''
+        Estimated seconds until the stage completes at its average rate. Returns
+        None if the total is unknown or no rows have been processed yet
+        '''
+
+        if self.done:
+            return 0.0
+
+        rate = self.rate()
+        if self.total is None or rate == 0:
+            return None
+
+        return max(self.total - self.processed, 0) / rate
+
+
+class Reporter:
+    '''
+    Writes the progress of every stage to a file in the Prometheus text
+    exposition format. When path is None nothing is written, so stages can be
+    instrumented unconditionally.
+    '''
+
+    def __init__(self, path: Union[str, None] = None, batch_size=DEFAULT_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.stages = {}
+
+    def stage(self, name: str, total: Union[int, None] = None) -> Stage:
+        '''
+        Start tracking a stage expected to process total rows
+        '''
+
+        stage = Stage(self, name, total, self.batch_size)
+        self.stages[name] = stage
+        self.write()
+
+        return stage
+
+    def format(self) -> str:
+        '''
+        Render all metrics in the Prometheus text exposition format
+        '''
+
+        metrics = [
+            ('rows_processed_total', 'counter', 'Rows processed by the stage',
+             lambda s: s.processed),
+            ('rows_expected', 'gauge', 'Rows the stage is expected to process',
+             lambda s: s.total),
+            ('rows_per_second', 'gauge', 'Average rows per second since the stage started',
+             lambda s: s.rate()),
+            ('eta_seconds', 'gauge', 'Estimated seconds until the stage completes',
+             lambda s: s.eta()),
+            ('queue_depth', 'gauge', 'Units of work waiting to be processed',
+             lambda s: s.queue_depth),
+            ('elapsed_seconds', 'gauge', 'Seconds since the stage started',
+             lambda s: s.elapsed()),
+            ('stage_done', 'gauge', '1 if the stage has completed',
+             lambda s: int(s.done)),
+        ]
+
+        lines = []
+
+        for name, kind, description, value in metrics:
+            lines.append(f'# HELP {METRIC_PREFIX}_{name} {description}')
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} {kind}')
+
+            for stage in self.stages.values():
+                v = value(stage)
+                if v is not None:
+                    lines.append(
+                        f'{METRIC_PREFIX}_{name}{{stage="{stage.name}"}} {v}')
+
+        memory = currentMemory()
+        if memory is not None:
+            lines.append(
+                f'# HELP {METRIC_PREFIX}_memory_bytes Current resident memory of the ingest process')
+            lines.append(f'# TYPE {METRIC_PREFIX}_memory_bytes gauge')
+            lines.append(f'{METRIC_PREFIX}_memory_bytes {memory}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self) -> None:
+        '''
+        Atomically replace the metrics file so readers never see a partial write
+        '''
+
+        if self.path is None:
+            return
+
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as file:
+            file.write(self.format())
+        os.replace(tmp_path, self.path)